@@ -11,6 +11,9 @@ to the subsystem. Comparing to the Adapter Pattern the Decorator Pattern doesn't
 interface but adds responsibility.
 '''
 from abc import ABC, abstractmethod
+import asyncio
+from functools import partial
+import threading
 
 
 # The interface that the client expects, or the target interface
@@ -52,6 +55,48 @@ class WildTurkey(Turkey):
         print('I\'m flying a short distance')
 
 
+# An adaptee with bulk operations, e.g. a legacy backend that is much faster when called with a batch
+class BatchTurkey(Turkey, ABC):
+    @abstractmethod
+    def gobble_many(self, num_calls):
+        """ gobble `num_calls` times """
+    @abstractmethod
+    def fly_many(self, num_calls):
+        """ fly `num_calls` times """
+
+
+class BatchWildTurkey(WildTurkey, BatchTurkey):
+    def gobble_many(self, num_calls):
+        print(f'Gobble gobble x{num_calls}')
+
+    def fly_many(self, num_calls):
+        print(f'I\'m flying a short distance x{num_calls}')
+
+
+def call_many(adaptee, method_name, num_calls):
+    """
+    Call `method_name` of the adaptee `num_calls` times, with a single call to its bulk method `<method_name>_many`
+    if the adaptee has one, otherwise one call at a time.
+    """
+    bulk_method = getattr(adaptee, f'{method_name}_many', None)
+    if bulk_method is not None:
+        bulk_method(num_calls)
+        return
+    method = getattr(adaptee, method_name)
+    for _ in range(num_calls):
+        method()
+
+
+def repeated(method_name, num_calls):
+    """
+    Returns a make_adapter mapping that translates one target call into `num_calls` calls of the adaptee's
+    `method_name`, see call_many.
+    """
+    def translate(adaptee):
+        call_many(adaptee, method_name, num_calls)
+    return translate
+
+
 # Adapter that adapts any Turkey object to Duck interface.
 class TurkeyAdapter(Duck):
     # turkey is our "adaptee"
@@ -63,5 +108,167 @@ class TurkeyAdapter(Duck):
         self._turkey.gobble()
 
     def fly(self):
-        for _ in range(5):
-            self._turkey.fly()
+        call_many(self._turkey, 'fly', 5)
+
+    # N target calls at once, forwarded as one bulk call when the turkey supports it
+    def quack_many(self, num_calls):
+        call_many(self._turkey, 'gobble', num_calls)
+
+    def fly_many(self, num_calls):
+        call_many(self._turkey, 'fly', 5 * num_calls)
+
+
+def make_adapter(target, method_map, adaptee_type=None, name=None):
+    """
+    Generate an adapter class for the `target` interface.
+
+    Parameters
+    ----------
+    target : type
+        The target interface, e.g. Duck.
+    method_map : dict
+        Maps each target method name either to the name of an adaptee method, which is called as is, or to a
+        function `f(adaptee, *args, **kwargs)` that performs the translation.
+    adaptee_type : type, optional
+        If given, adaptees are checked to be instances of it.
+    name : str, optional
+        Name of the generated class.
+
+    Returns
+    -------
+    type
+        A subclass of `target` whose instances are created with the adaptee. Methods mapped to a name are bound
+        directly to the adaptee's bound methods, so calling them does not go through an extra adapter frame.
+    """
+    missing = getattr(target, '__abstractmethods__', frozenset()) - set(method_map)
+    assert not missing, f'No mapping for the abstract methods {sorted(missing)}'
+
+    def __init__(self, adaptee):
+        if adaptee_type is not None:
+            assert isinstance(adaptee, adaptee_type)
+        self._adaptee = adaptee
+        for method_name, mapped in method_map.items():
+            if isinstance(mapped, str):
+                setattr(self, method_name, getattr(adaptee, mapped))
+            else:
+                setattr(self, method_name, partial(mapped, adaptee))
+
+    def make_method(method_name, mapped):
+        # only used when the method is looked up on the class, instances have their own bound callables
+        if isinstance(mapped, str):
+            def method(self, *args, **kwargs):
+                return getattr(self._adaptee, mapped)(*args, **kwargs)
+        else:
+            def method(self, *args, **kwargs):
+                return mapped(self._adaptee, *args, **kwargs)
+        method.__name__ = method_name
+        return method
+
+    namespace = {'__init__': __init__}
+    for method_name, mapped in method_map.items():
+        namespace[method_name] = make_method(method_name, mapped)
+    if name is None:
+        name = f'{target.__name__}Adapter'
+    return type(name, (target,), namespace)
+
+
+# The same adapter as TurkeyAdapter, generated
+GeneratedTurkeyAdapter = make_adapter(Duck, {'quack': 'gobble', 'fly': repeated('fly', 5)}, adaptee_type=Turkey,
+                                      name='GeneratedTurkeyAdapter')
+
+
+# Bridges between synchronous and asyncio interfaces
+class AsyncDuck(ABC):
+    """
+    Asyncio version of the Duck interface.
+    """
+
+    @abstractmethod
+    async def quack(self):
+        """ quack """
+
+    @abstractmethod
+    async def fly(self):
+        """ fly """
+
+
+class AsyncTurkeyAdapter(AsyncDuck):
+    """
+    Adapts a synchronous Turkey to the AsyncDuck interface.
+
+    The turkey's blocking calls run on `executor`, by default the event loop's default thread pool, which is bounded,
+    so they never stall the event loop.
+    """
+
+    def __init__(self, turkey, executor=None):
+        assert isinstance(turkey, Turkey)
+        self._turkey = turkey
+        self._executor = executor
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, partial(func, *args))
+
+    async def quack(self):
+        await self._run(self._turkey.gobble)
+
+    async def fly(self):
+        await self._run(call_many, self._turkey, 'fly', 5)
+
+
+class AsyncTurkey(ABC):
+    """
+    Asyncio version of the Turkey interface.
+    """
+
+    @abstractmethod
+    async def gobble(self):
+        """ gobble """
+
+    @abstractmethod
+    async def fly(self):
+        """ fly """
+
+
+class AsyncWildTurkey(AsyncTurkey):
+    async def gobble(self):
+        await asyncio.sleep(0)
+        print('Gobble gobble')
+
+    async def fly(self):
+        await asyncio.sleep(0)
+        print('I\'m flying a short distance')
+
+
+class SyncTurkeyFacade(Turkey):
+    """
+    Adapts an AsyncTurkey to the synchronous Turkey interface, e.g. to use it with TurkeyAdapter.
+
+    The coroutines run on `loop`, which must be running in another thread. By default the facade starts its own loop
+    in a daemon thread, stopped by `close`. The blocking methods must not be called from the loop's thread.
+    """
+
+    def __init__(self, turkey, loop=None):
+        assert isinstance(turkey, AsyncTurkey)
+        self._turkey = turkey
+        self._thread = None
+        if loop is None:
+            loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(target=loop.run_forever, daemon=True)
+            self._thread.start()
+        self._loop = loop
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    def gobble(self):
+        return self._run(self._turkey.gobble())
+
+    def fly(self):
+        return self._run(self._turkey.fly())
+
+    def close(self):
+        if self._thread is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+            self._thread = None
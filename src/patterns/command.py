@@ -17,7 +17,14 @@ In addition to `execute` and `undo`, commands may also be used to implement logg
 and transactional systems. This can by done by add methods such as `log`, `store`, `load`.
 '''
 from abc import ABC, abstractmethod
+from array import array
+from bisect import bisect_left
+from concurrent.futures import Future, ThreadPoolExecutor
+import json
+import os
 import sys
+import threading
+import time
 
 
 class Light(object):
@@ -55,6 +62,9 @@ class GarageDoor(object):
     def light_off(self):
         self._light.off()
 
+    def get_light(self):
+        return self._light
+
 
 class AbsCommand(ABC):
     """
@@ -75,6 +85,20 @@ class AbsCommand(ABC):
         Undo the execution
         """
 
+    def get_receivers(self):
+        """
+        Returns the receivers the command acts on, used to keep the order of commands per receiver.
+        """
+        return ()
+
+    def get_coalesce_key(self):
+        """
+        Commands with the same coalesce key put their receiver in a state that does not depend on the previous
+        commands with that key, so only the last of them has to be executed. None means the command cannot be
+        coalesced.
+        """
+        return None
+
 
 class NoCommand(AbsCommand):
     """ A null command """
@@ -85,6 +109,13 @@ class NoCommand(AbsCommand):
     def undo(self):
         pass
 
+    def store(self, receiver_names):
+        return {'command': type(self).__name__}
+
+    @classmethod
+    def load(cls, record, receivers):
+        return cls()
+
 
 class AbsLightCommand(AbsCommand, ABC):
     def __init__(self, light):
@@ -95,6 +126,19 @@ class AbsLightCommand(AbsCommand, ABC):
         assert isinstance(light, Light)
         self._light = light
 
+    def get_receivers(self):
+        return (self._light,)
+
+    def get_coalesce_key(self):
+        return (AbsLightCommand, id(self._light))
+
+    def store(self, receiver_names):
+        return {'command': type(self).__name__, 'receiver': receiver_names[id(self._light)]}
+
+    @classmethod
+    def load(cls, record, receivers):
+        return cls(receivers[record['receiver']])
+
 
 class LightOnCommand(AbsLightCommand):
 
@@ -125,6 +169,19 @@ class AbsGarageDoorCommand(AbsCommand, ABC):
         assert isinstance(garage_door, GarageDoor)
         self._garage_door = garage_door
 
+    def get_receivers(self):
+        return (self._garage_door, self._garage_door.get_light())
+
+    def get_coalesce_key(self):
+        return (AbsGarageDoorCommand, id(self._garage_door))
+
+    def store(self, receiver_names):
+        return {'command': type(self).__name__, 'receiver': receiver_names[id(self._garage_door)]}
+
+    @classmethod
+    def load(cls, record, receivers):
+        return cls(receivers[record['receiver']])
+
 
 class GarageDoorOpenCommand(AbsGarageDoorCommand):
     """ A concrete command """
@@ -167,6 +224,230 @@ class MacroCommand(AbsCommand):
         for command in self._command_list[::-1]:
             command.undo()
 
+    def get_receivers(self):
+        receivers = dict()
+        for command in self._command_list:
+            for receiver in command.get_receivers():
+                receivers[id(receiver)] = receiver
+        return tuple(receivers.values())
+
+    def get_commands(self):
+        return list(self._command_list)
+
+    def store(self, receiver_names):
+        return {'command': type(self).__name__,
+                'commands': [command.store(receiver_names) for command in self._command_list]}
+
+    @classmethod
+    def load(cls, record, receivers):
+        return cls([load_command(command_record, receivers) for command_record in record['commands']])
+
+
+class CommandTransaction(object):
+    """
+    Executes commands as a unit: if one raises, the already executed ones are undone in reverse order.
+
+    Used as a context manager, an exception inside the block rolls back every command executed through the
+    transaction. `savepoint` marks the current position, `rollback_to` undoes the commands executed after a savepoint.
+    """
+
+    def __init__(self):
+        self._applied = list()
+
+    def execute(self, command):
+        """
+        Execute `command`, rolling back the whole transaction if it raises.
+        """
+        assert isinstance(command, AbsCommand)
+        try:
+            command.execute()
+        except Exception:
+            self.rollback()
+            raise
+        self._applied.append(command)
+
+    def savepoint(self):
+        """
+        Returns
+        -------
+        int
+            A savepoint that can be passed to `rollback_to`.
+        """
+        return len(self._applied)
+
+    def rollback_to(self, savepoint):
+        """
+        Undo, in reverse order, the commands executed after `savepoint`.
+        """
+        assert 0 <= savepoint <= len(self._applied)
+        while len(self._applied) > savepoint:
+            self._applied.pop().undo()
+
+    def rollback(self):
+        self.rollback_to(0)
+
+    def commit(self):
+        """
+        Keep the executed commands, they can no longer be rolled back.
+        """
+        self._applied.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+
+
+class TransactionalMacroCommand(MacroCommand):
+    """
+    A macro command that is applied atomically: if one of its commands raises, the commands executed before it are
+    undone in reverse order and the error is raised again.
+    """
+
+    def execute(self):
+        transaction = CommandTransaction()
+        for command in self._command_list:
+            transaction.execute(command)
+        transaction.commit()
+
+
+# thread pool shared by the parallel macros that are not given an executor, created on first use
+_shared_executor = None
+_shared_executor_lock = threading.Lock()
+# set in the threads running commands of a parallel macro on the shared pool
+_in_shared_executor = threading.local()
+
+
+def _get_shared_executor():
+    global _shared_executor
+    with _shared_executor_lock:
+        if _shared_executor is None:
+            _shared_executor = ThreadPoolExecutor(thread_name_prefix='ParallelMacroCommand')
+        return _shared_executor
+
+
+def _run_in_shared_executor(action):
+    _in_shared_executor.active = True
+    try:
+        return action()
+    finally:
+        _in_shared_executor.active = False
+
+
+class ParallelMacroCommand(MacroCommand):
+    """
+    A macro command that executes independent commands concurrently.
+
+    The dependencies between the commands form a DAG, given as a dict mapping the index of a command to the indices
+    of the commands that have to run before it. By default a command depends on the previous commands sharing one of
+    its receivers. The commands are grouped in levels of the DAG, the commands of a level run concurrently on a thread
+    pool and a level starts once the previous one finished. Undo runs the levels in reverse order.
+
+    The pool is `executor` if given, owned by the caller, otherwise a thread pool shared by all parallel macros. A
+    parallel macro nested in another one runs its levels serially on the shared pool, so it never waits for a worker
+    of the pool it is running on.
+    """
+
+    def __init__(self, command_list=None, dependencies=None, executor=None):
+        super().__init__(command_list)
+        if dependencies is None:
+            dependencies = self._infer_dependencies(self._command_list)
+        self._dependencies = {index: sorted(set(dependencies[index])) for index in sorted(dependencies)}
+        self._levels = self._build_levels(len(self._command_list), self._dependencies)
+        self._executor = executor
+
+    @staticmethod
+    def _infer_dependencies(command_list):
+        dependencies = dict()
+        last_by_receiver = dict()
+        for index, command in enumerate(command_list):
+            for receiver in command.get_receivers():
+                previous = last_by_receiver.get(id(receiver))
+                if previous is not None:
+                    dependencies.setdefault(index, set()).add(previous)
+                last_by_receiver[id(receiver)] = index
+        return dependencies
+
+    @staticmethod
+    def _build_levels(num_commands, dependencies):
+        level_of = dict()
+        def get_level(index, visiting):
+            if index in level_of:
+                return level_of[index]
+            if index in visiting:
+                raise ValueError(f'Dependency cycle through command {index}')
+            visiting.add(index)
+            level = 0
+            for dependency in dependencies.get(index, ()):
+                assert 0 <= dependency < num_commands
+                level = max(level, get_level(dependency, visiting) + 1)
+            visiting.discard(index)
+            level_of[index] = level
+            return level
+
+        levels = list()
+        for index in range(num_commands):
+            level = get_level(index, set())
+            while len(levels) <= level:
+                levels.append(list())
+            levels[level].append(index)
+        return levels
+
+    def _run_levels(self, levels, undo):
+        serial = self._executor is None and getattr(_in_shared_executor, 'active', False)
+        for level in levels:
+            actions = [self._command_list[index].undo if undo else self._command_list[index].execute
+                       for index in level]
+            if len(actions) == 1 or serial:
+                for action in actions:
+                    action()
+                continue
+            if self._executor is None:
+                futures = [_get_shared_executor().submit(_run_in_shared_executor, action) for action in actions]
+            else:
+                futures = [self._executor.submit(action) for action in actions]
+            # let the whole level finish before raising the first error
+            for future in futures:
+                future.exception()
+            for future in futures:
+                future.result()
+
+    def execute(self):
+        self._run_levels(self._levels, undo=False)
+
+    def undo(self):
+        self._run_levels(self._levels[::-1], undo=True)
+
+    def store(self, receiver_names):
+        record = super().store(receiver_names)
+        # JSON object keys are strings, so the DAG is stored as a list of [index, dependencies]
+        record['dependencies'] = [[index, dependencies] for index, dependencies in self._dependencies.items()]
+        return record
+
+    @classmethod
+    def load(cls, record, receivers):
+        return cls([load_command(command_record, receivers) for command_record in record['commands']],
+                   dependencies={index: dependencies for index, dependencies in record['dependencies']})
+
+
+def load_command(record, receivers):
+    """
+    Rebuild a command from a record created by `AbsCommand.store`.
+    """
+    return COMMAND_CLASSES[record['command']].load(record, receivers)
+
+
+# Commands that can be stored in and loaded from a journal, by class name. A storable command implements
+# `store(receiver_names)`, returning a JSON serializable record that refers to receivers by name, and the class method
+# `load(record, receivers)` rebuilding the command from the record and a dict of receivers by name.
+COMMAND_CLASSES = {command_class.__name__: command_class for command_class in (
+    NoCommand, LightOnCommand, LightOffCommand, GarageDoorOpenCommand, GarageDoorCloseCommand, MacroCommand,
+    TransactionalMacroCommand, ParallelMacroCommand)}
+
 
 class SimpleRemoteControl(object):
     """ Invoker
@@ -228,6 +509,695 @@ class RemoteControlWithUndo(object):
         self._undo_command.undo()
 
 
+class FastRemoteControl(object):
+    """
+    Remote control with undo that validates commands once, when they are set.
+
+    The bound `execute`/`undo` methods of the commands are stored per slot, so pressing a button is an indexed call
+    with no checks. Messages go to the optional `log` callable instead of being printed.
+    """
+
+    def __init__(self, num_slots, log=None):
+        assert isinstance(num_slots, int)
+        assert log is None or callable(log)
+        no_command = NoCommand()
+        self._on_executes = [no_command.execute] * num_slots
+        self._on_undos = [no_command.undo] * num_slots
+        self._off_executes = [no_command.execute] * num_slots
+        self._off_undos = [no_command.undo] * num_slots
+        self._undo = no_command.undo
+        self._num_slots = num_slots
+        self._log = log
+
+    def set_command(self, slot, on_command, off_command):
+        assert isinstance(slot, int)
+        assert 0 <= slot < self._num_slots
+        assert isinstance(on_command, AbsCommand)
+        assert isinstance(off_command, AbsCommand)
+        self._on_executes[slot] = on_command.execute
+        self._on_undos[slot] = on_command.undo
+        self._off_executes[slot] = off_command.execute
+        self._off_undos[slot] = off_command.undo
+        if self._log is not None:
+            self._log(f'Set commands for slot number {slot}')
+
+    def on_button_was_pushed(self, slot):
+        if self._log is not None:
+            self._log(f'On button at slot number {slot} was pushed')
+        self._on_executes[slot]()
+        self._undo = self._on_undos[slot]
+
+    def off_button_was_pushed(self, slot):
+        if self._log is not None:
+            self._log(f'Off button at slot number {slot} was pushed')
+        self._off_executes[slot]()
+        self._undo = self._off_undos[slot]
+
+    def undo_button_was_pushed(self):
+        if self._log is not None:
+            self._log('Undo button was pushed')
+        self._undo()
+
+
+class CommandMetrics(object):
+    """
+    Collects latency histograms per command class and per receiver, error counts and queue wait times.
+
+    Collection can be switched on and off at runtime with `enabled`; when it is off traced commands only pay for
+    checking the flag.
+    """
+    # upper bounds, in seconds, of the histogram buckets, the last bucket is unbounded
+    LATENCY_BUCKETS = (1e-6, 1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1.0, 10.0)
+
+    def __init__(self, receiver_names=None, enabled=True):
+        """
+        Parameters
+        ----------
+        receiver_names : dict, optional
+            Maps receivers to the names used in the snapshot, by default receivers are named by class and id.
+        enabled : bool
+            Whether to start collecting right away.
+        """
+        if receiver_names is None:
+            receiver_names = dict()
+        self._receiver_names = {id(receiver): name for receiver, name in receiver_names.items()}
+        self._lock = threading.Lock()
+        self.enabled = enabled
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._by_command = dict()
+            self._by_receiver = dict()
+            self._errors = dict()
+            self._queue_wait = [0] * (len(self.LATENCY_BUCKETS) + 2)
+
+    def _get_receiver_name(self, receiver):
+        name = self._receiver_names.get(id(receiver))
+        if name is None:
+            name = f'{type(receiver).__name__}@{id(receiver):x}'
+        return name
+
+    def _observe(self, histogram, seconds):
+        # the last item of a histogram is the sum of the observations
+        histogram[bisect_left(self.LATENCY_BUCKETS, seconds)] += 1
+        histogram[-1] += seconds
+
+    def record(self, command, action, seconds, failed=False):
+        """
+        Record one `execute` or `undo` of `command` that took `seconds`.
+        """
+        command_key = f'{type(command).__name__}.{action}'
+        with self._lock:
+            histogram = self._by_command.get(command_key)
+            if histogram is None:
+                histogram = self._by_command[command_key] = [0] * (len(self.LATENCY_BUCKETS) + 2)
+            self._observe(histogram, seconds)
+            for receiver in command.get_receivers():
+                receiver_key = self._get_receiver_name(receiver)
+                histogram = self._by_receiver.get(receiver_key)
+                if histogram is None:
+                    histogram = self._by_receiver[receiver_key] = [0] * (len(self.LATENCY_BUCKETS) + 2)
+                self._observe(histogram, seconds)
+            if failed:
+                self._errors[command_key] = self._errors.get(command_key, 0) + 1
+
+    def record_queue_wait(self, seconds):
+        with self._lock:
+            self._observe(self._queue_wait, seconds)
+
+    def _export(self, histogram):
+        bucket_names = [f'le_{bound:g}' for bound in self.LATENCY_BUCKETS] + ['inf']
+        return {'buckets': dict(zip(bucket_names, histogram)), 'count': sum(histogram[:-1]), 'sum': histogram[-1]}
+
+    def snapshot(self):
+        """
+        Returns
+        -------
+        dict
+            Plain dict of the latency histograms (in seconds) and error counts.
+        """
+        with self._lock:
+            return {
+                'commands': {key: self._export(histogram) for key, histogram in self._by_command.items()},
+                'receivers': {key: self._export(histogram) for key, histogram in self._by_receiver.items()},
+                'errors': dict(self._errors),
+                'queue_wait': self._export(self._queue_wait),
+            }
+
+
+class TracedCommand(AbsCommand):
+    """
+    Decorates a command to report the latency of its `execute` and `undo` to a CommandMetrics.
+    """
+
+    def __init__(self, command, metrics):
+        assert isinstance(command, AbsCommand)
+        assert isinstance(metrics, CommandMetrics)
+        self._command = command
+        self._metrics = metrics
+
+    def _trace(self, action):
+        method = getattr(self._command, action)
+        if not self._metrics.enabled:
+            return method()
+        start = time.perf_counter()
+        try:
+            result = method()
+        except Exception:
+            self._metrics.record(self._command, action, time.perf_counter() - start, failed=True)
+            raise
+        self._metrics.record(self._command, action, time.perf_counter() - start)
+        return result
+
+    def execute(self):
+        return self._trace('execute')
+
+    def undo(self):
+        return self._trace('undo')
+
+    def get_command(self):
+        return self._command
+
+    def get_receivers(self):
+        return self._command.get_receivers()
+
+    def get_coalesce_key(self):
+        return self._command.get_coalesce_key()
+
+
+class TracedSimpleRemoteControl(SimpleRemoteControl):
+    """
+    SimpleRemoteControl whose commands are traced, see CommandMetrics.
+    """
+
+    def __init__(self, metrics, command=None):
+        assert isinstance(metrics, CommandMetrics)
+        self._metrics = metrics
+        super().__init__()
+        if command is not None:
+            self.set_command(command)
+
+    def set_command(self, command):
+        super().set_command(TracedCommand(command, self._metrics))
+
+
+class TracedRemoteControlWithUndo(RemoteControlWithUndo):
+    """
+    RemoteControlWithUndo whose commands are traced, see CommandMetrics.
+    """
+
+    def __init__(self, num_slots, metrics):
+        assert isinstance(metrics, CommandMetrics)
+        self._metrics = metrics
+        super().__init__(num_slots)
+
+    def set_command(self, slot, on_command, off_command):
+        super().set_command(slot, TracedCommand(on_command, self._metrics), TracedCommand(off_command, self._metrics))
+
+
+def _daemon_timer(interval, function):
+    timer = threading.Timer(interval, function)
+    timer.daemon = True
+    return timer
+
+
+class CoalescingRemoteControl(RemoteControlWithUndo):
+    """
+    Remote control that holds back bursts of button presses and only executes what makes a difference.
+
+    Pressed commands are kept pending for `window` seconds after the first press of a burst, then a timer executes
+    them. Pending commands with the same coalesce key (e.g. on/off commands on the same light) collapse to the last
+    one, which is dropped entirely if it is redundant: the same kind of command as the last one executed on each of
+    its receivers. `flush` executes the pending commands right away. Commands that cannot be coalesced, and undo,
+    flush the pending commands first, so undo still reverts the last pressed command.
+
+    `timer_factory(interval, function)` returns an object with `start` and `cancel` that calls `function` after
+    `interval` seconds, a daemon threading.Timer by default. Commands then run on the timer's thread.
+
+    A command raising does not stop the flush, the remaining pending commands are still executed and the first error
+    is raised afterwards. The error of a flush run by the timer is kept and raised by the next call to `flush`.
+    """
+
+    def __init__(self, num_slots, window=0.05, timer_factory=_daemon_timer):
+        super().__init__(num_slots)
+        assert window >= 0
+        self._window = window
+        self._timer_factory = timer_factory
+        self._timer = None
+        self._lock = threading.RLock()
+        self._pending = dict()
+        # last command executed on each receiver, by receiver id
+        self._last_executed = dict()
+        # first error of a flush run by the timer, not raised yet
+        self._timer_error = None
+
+    def on_button_was_pushed(self, slot):
+        assert isinstance(slot, int)
+        assert slot < self._num_slots
+        print(f'On button at slot number {slot} was pushed')
+        self._push(self._on_commands[slot])
+
+    def off_button_was_pushed(self, slot):
+        assert isinstance(slot, int)
+        assert slot < self._num_slots
+        print(f'Off button at slot number {slot} was pushed')
+        self._push(self._off_commands[slot])
+
+    def undo_button_was_pushed(self):
+        with self._lock:
+            self.flush()
+            # the receivers' state is not known after an undo
+            self._last_executed.clear()
+            super().undo_button_was_pushed()
+
+    def _push(self, command):
+        with self._lock:
+            self._undo_command = command
+            key = command.get_coalesce_key()
+            if key is None:
+                self.flush()
+                self._execute(command)
+                return
+            # re-inserting keeps the pending commands in the order of their last press
+            self._pending.pop(key, None)
+            self._pending[key] = command
+            if self._window == 0:
+                self.flush()
+            elif self._timer is None:
+                self._timer = self._timer_factory(self._window, self._flush_on_timer)
+                self._timer.start()
+
+    def flush(self):
+        """
+        Execute the pending commands now.
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            error = self._timer_error
+            self._timer_error = None
+            pending = self._pending
+            self._pending = dict()
+            for command in pending.values():
+                receivers = command.get_receivers()
+                if not receivers or any(type(self._last_executed.get(id(receiver))) is not type(command)
+                                        for receiver in receivers):
+                    try:
+                        self._execute(command)
+                    except Exception as e:
+                        error = error or e
+            if error is not None:
+                raise error
+
+    def _flush_on_timer(self):
+        with self._lock:
+            try:
+                self.flush()
+            except Exception as e:
+                self._timer_error = e
+
+    def _execute(self, command):
+        command.execute()
+        for receiver in command.get_receivers():
+            self._last_executed[id(receiver)] = command
+
+
+class CommandHistory(object):
+    """
+    Bounded undo/redo history of commands.
+
+    The undo history is a ring buffer of `depth` integer records, once it is full the oldest entry is dropped.
+    Records are ids into a table of the distinct commands currently in the history, reference counted, so recording
+    the same commands millions of times only costs a few bytes per entry. Push and pop are O(1). A MacroCommand is
+    recorded, undone and redone as a single entry.
+    """
+
+    def __init__(self, depth=1024):
+        assert isinstance(depth, int) and depth > 0
+        self._depth = depth
+        self._undo_ids = array('q', bytes(8 * depth))
+        self._undo_start = 0
+        self._undo_len = 0
+        self._redo_ids = array('q')
+        self._commands = list()
+        self._refcounts = list()
+        self._command_ids = dict()
+        self._free_ids = list()
+
+    def __len__(self):
+        return self._undo_len
+
+    def get_redo_len(self):
+        return len(self._redo_ids)
+
+    def _acquire(self, command):
+        command_id = self._command_ids.get(id(command))
+        if command_id is not None:
+            self._refcounts[command_id] += 1
+            return command_id
+        if self._free_ids:
+            command_id = self._free_ids.pop()
+            self._commands[command_id] = command
+            self._refcounts[command_id] = 1
+        else:
+            command_id = len(self._commands)
+            self._commands.append(command)
+            self._refcounts.append(1)
+        self._command_ids[id(command)] = command_id
+        return command_id
+
+    def _release(self, command_id):
+        self._refcounts[command_id] -= 1
+        if self._refcounts[command_id] == 0:
+            del self._command_ids[id(self._commands[command_id])]
+            self._commands[command_id] = None
+            self._free_ids.append(command_id)
+
+    def _push_undo(self, command_id):
+        if self._undo_len == self._depth:
+            self._release(self._undo_ids[self._undo_start])
+            self._undo_start = (self._undo_start + 1) % self._depth
+            self._undo_len -= 1
+        self._undo_ids[(self._undo_start + self._undo_len) % self._depth] = command_id
+        self._undo_len += 1
+
+    def push(self, command):
+        """
+        Record an executed command, this clears the redo history.
+        """
+        assert isinstance(command, AbsCommand)
+        self._push_undo(self._acquire(command))
+        while self._redo_ids:
+            self._release(self._redo_ids.pop())
+
+    def undo(self):
+        """
+        Move the last executed command to the redo history.
+
+        Returns
+        -------
+        AbsCommand or None
+            The command to undo, None if the history is empty.
+        """
+        if not self._undo_len:
+            return None
+        self._undo_len -= 1
+        command_id = self._undo_ids[(self._undo_start + self._undo_len) % self._depth]
+        self._redo_ids.append(command_id)
+        return self._commands[command_id]
+
+    def redo(self):
+        """
+        Move the last undone command back to the undo history.
+
+        Returns
+        -------
+        AbsCommand or None
+            The command to execute again, None if there is nothing to redo.
+        """
+        if not self._redo_ids:
+            return None
+        command_id = self._redo_ids.pop()
+        self._push_undo(command_id)
+        return self._commands[command_id]
+
+
+class RemoteControlWithHistory(RemoteControlWithUndo):
+    """
+    Remote control with multi-level undo and redo, see CommandHistory.
+    """
+
+    def __init__(self, num_slots, depth=1024):
+        super().__init__(num_slots)
+        self._history = CommandHistory(depth)
+
+    def on_button_was_pushed(self, slot):
+        super().on_button_was_pushed(slot)
+        self._history.push(self._on_commands[slot])
+
+    def off_button_was_pushed(self, slot):
+        super().off_button_was_pushed(slot)
+        self._history.push(self._off_commands[slot])
+
+    def undo_button_was_pushed(self):
+        print('Undo button was pushed')
+        command = self._history.undo()
+        if command is not None:
+            command.undo()
+
+    def redo_button_was_pushed(self):
+        print('Redo button was pushed')
+        command = self._history.redo()
+        if command is not None:
+            command.execute()
+
+
+class CommandQueue(object):
+    """
+    Invoker that executes commands on an executor (a thread pool by default) and returns futures.
+
+    Commands sharing a receiver run in the order they were submitted, commands on different receivers run
+    concurrently. A command is only handed to the executor once the previous commands on all of its receivers have
+    finished, so no worker is blocked waiting. With a process pool the commands and receivers are pickled, so only
+    receivers that proxy an external device make sense there.
+
+    If `metrics` is given and enabled, the time from submission until a worker starts the command is recorded as
+    queue wait; this wraps the command in a closure, so it only works with a thread pool.
+    """
+
+    def __init__(self, executor=None, max_workers=None, metrics=None):
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=max_workers)
+        assert metrics is None or isinstance(metrics, CommandMetrics)
+        self._executor = executor
+        self._metrics = metrics
+        self._lock = threading.Lock()
+        # per receiver id, the slot of the last submitted command: an internal future resolved once the command
+        # finished or, if it was cancelled, once it would have started, so cancelling never lets a later command
+        # overtake an earlier one that is still running
+        self._tails = dict()
+
+    def submit(self, command, undo=False):
+        """
+        Queue the execution (or the undo) of `command`.
+
+        Returns
+        -------
+        concurrent.futures.Future
+            Resolves once the command ran, with the exception it raised if any.
+        """
+        assert isinstance(command, AbsCommand)
+        future = Future()
+        slot = Future()
+        keys = [id(receiver) for receiver in command.get_receivers()]
+        with self._lock:
+            previous = [self._tails[key] for key in keys if key in self._tails]
+            for key in keys:
+                self._tails[key] = slot
+        slot.add_done_callback(lambda _: self._release(keys, slot))
+
+        action = command.undo if undo else command.execute
+        if self._metrics is not None and self._metrics.enabled:
+            action = self._wait_timed(action, time.perf_counter())
+        if not previous:
+            self._start(action, future, slot)
+            return future
+
+        remaining = [len(previous)]
+        def on_previous_done(_):
+            with self._lock:
+                remaining[0] -= 1
+                ready = remaining[0] == 0
+            if ready:
+                self._start(action, future, slot)
+        for previous_slot in previous:
+            previous_slot.add_done_callback(on_previous_done)
+        return future
+
+    def _wait_timed(self, action, submitted):
+        def timed_action():
+            self._metrics.record_queue_wait(time.perf_counter() - submitted)
+            return action()
+        return timed_action
+
+    def _start(self, action, future, slot):
+        if not future.set_running_or_notify_cancel():
+            slot.set_result(None)
+            return
+        try:
+            inner = self._executor.submit(action)
+        except Exception as e:
+            future.set_exception(e)
+            slot.set_result(None)
+            return
+        inner.add_done_callback(lambda done: self._copy_result(done, future, slot))
+
+    @staticmethod
+    def _copy_result(done, future, slot):
+        exception = done.exception()
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(done.result())
+        slot.set_result(None)
+
+    def _release(self, keys, slot):
+        with self._lock:
+            for key in keys:
+                if self._tails.get(key) is slot:
+                    del self._tails[key]
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+
+class CommandJournal(object):
+    """
+    Invoker that records executed commands in an append-only journal, so receivers can be restored after a crash.
+
+    Each execution is a JSON line naming the command class and its receivers. Lines are buffered and committed in
+    groups: one write and one fsync per `batch_size` commands, or when `commit` is called. Commands executed since the
+    last commit are not durable yet. `replay` executes the committed commands again on fresh receivers.
+
+    Only the commands registered in COMMAND_CLASSES, acting on the receivers given to the journal, can be journaled.
+    Other commands are rejected with a ValueError before they are executed.
+    """
+
+    def __init__(self, path, receivers, batch_size=256):
+        """
+        Parameters
+        ----------
+        path : str
+            Journal file, appended to if it exists.
+        receivers : dict
+            Maps names to the receivers the journaled commands act on.
+        batch_size : int
+            Number of commands per group commit.
+        """
+        assert isinstance(receivers, dict)
+        assert isinstance(batch_size, int) and batch_size > 0
+        self._receiver_names = {id(receiver): name for name, receiver in receivers.items()}
+        self._batch_size = batch_size
+        self._buffer = list()
+        # encoded records of simple commands by (class, action, receiver ids), bounded by the number of command
+        # classes times the number of receivers
+        self._encoded = dict()
+        self._file = open(path, 'a+b')
+        self._truncate_torn_line()
+
+    def _truncate_torn_line(self):
+        # drop a partially written last line, e.g. after a crash, so new records start on a line of their own
+        size = self._file.seek(0, os.SEEK_END)
+        end = size
+        chunk_size = 4096
+        while end > 0:
+            start = max(0, end - chunk_size)
+            self._file.seek(start)
+            newline = self._file.read(end - start).rfind(b'\n')
+            if newline >= 0:
+                end = start + newline + 1
+                break
+            end = start
+        if end != size:
+            self._file.truncate(end)
+
+    def execute(self, command):
+        line = self._encode(command, 'execute')
+        command.execute()
+        self._append(line)
+
+    def undo(self, command):
+        line = self._encode(command, 'undo')
+        command.undo()
+        self._append(line)
+
+    @staticmethod
+    def _check_storable(command):
+        if COMMAND_CLASSES.get(type(command).__name__) is not type(command):
+            raise ValueError(f'{type(command).__name__} is not registered in COMMAND_CLASSES, it cannot be journaled')
+        if isinstance(command, MacroCommand):
+            for sub_command in command.get_commands():
+                CommandJournal._check_storable(sub_command)
+
+    def _encode(self, command, action):
+        is_macro = isinstance(command, MacroCommand)
+        if not is_macro:
+            key = (type(command), action, tuple(id(receiver) for receiver in command.get_receivers()))
+            line = self._encoded.get(key)
+            if line is not None:
+                return line
+        self._check_storable(command)
+        try:
+            record = command.store(self._receiver_names)
+        except KeyError:
+            raise ValueError(f'{type(command).__name__} acts on a receiver unknown to the journal')
+        record['action'] = action
+        line = json.dumps(record, separators=(',', ':'))
+        # macros are encoded every time, their records depend on their commands
+        if not is_macro:
+            self._encoded[key] = line
+        return line
+
+    def _append(self, line):
+        self._buffer.append(line)
+        if len(self._buffer) >= self._batch_size:
+            self.commit()
+
+    def commit(self):
+        """
+        Write and fsync the buffered records.
+        """
+        if not self._buffer:
+            return
+        self._buffer.append('')
+        self._file.write('\n'.join(self._buffer).encode())
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._buffer.clear()
+
+    def close(self):
+        self.commit()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @staticmethod
+    def replay(path, receivers):
+        """
+        Execute the journaled commands again on `receivers`, a torn last line is ignored.
+
+        Returns
+        -------
+        int
+            Number of replayed commands.
+        """
+        num_replayed = 0
+        with open(path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                record = json.loads(line)
+                command = load_command(record, receivers)
+                if record['action'] == 'undo':
+                    command.undo()
+                else:
+                    command.execute()
+                num_replayed += 1
+        return num_replayed
+
+
 def main():
     print('Testing simple remote control')
     remote = SimpleRemoteControl()
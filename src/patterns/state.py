@@ -39,6 +39,14 @@ Benefits:
 
 from abc import ABC
 from abc import abstractmethod
+import asyncio
+from bisect import bisect_left
+from collections import deque
+from contextlib import redirect_stdout
+import io
+import os
+import struct
+import time
 
 # We will implement the gumball machine example
 
@@ -177,13 +185,225 @@ class SoldOutState(AbsGBState):
     def dispense(self):
         print(f'All sold out')
 
+# Event-sourced transition log
+ACTION_INSERT_QUARTER = 0
+ACTION_EJECT_QUARTER = 1
+ACTION_TURN_CRANK = 2
+ACTION_NAMES = ('insert_quarter', 'eject_quarter', 'turn_crank')
+
+# State codes used in the binary log, the code is the index in the tuple.
+STATE_CLASSES = (NoQuarterState, HasQuarterState, OneBallWinState, TwoBallWinState, SoldOutState)
+STATE_CODES = {state_class: code for code, state_class in enumerate(STATE_CLASSES)}
+
+
+class TransitionLog(object):
+    """
+    Append-only binary log of the actions performed on a gumball machine.
+
+    Every action is stored as a fixed size record: action, from-state, to-state and count delta.
+    Records are buffered in memory and written with a single call every `flush_every` records, so
+    logging does not add a syscall per crank. Every `snapshot_every` records a snapshot
+    (record index, state, count) is appended to a sidecar file `<path>.snap`, replaying starts from the
+    latest snapshot and only has to apply the tail of the log.
+    """
+    RECORD = struct.Struct('<BBBh')
+    SNAPSHOT = struct.Struct('<QBq')
+
+    def __init__(self, path, flush_every=512, snapshot_every=4096):
+        assert isinstance(flush_every, int) and flush_every > 0
+        assert isinstance(snapshot_every, int) and snapshot_every > 0
+        self._path = path
+        self._snapshot_path = path + '.snap'
+        self._flush_every = flush_every
+        self._snapshot_every = snapshot_every
+        self._buffer = bytearray()
+        self._num_buffered = 0
+        self._state_code = None
+        self._count = None
+        self._file = open(path, 'ab', buffering=0)
+        self._snapshot_file = open(self._snapshot_path, 'ab', buffering=0)
+        # ignore a partially written trailing record, e.g. after a crash
+        self._num_records = self._file.seek(0, os.SEEK_END) // self.RECORD.size
+        self._file.truncate(self._num_records * self.RECORD.size)
+        self._last_snapshot = self._num_records
+
+    def start(self, gb_state, count):
+        """
+        Record the initial state of the machine the log is attached to.
+        """
+        self._state_code = STATE_CODES[type(gb_state)]
+        self._count = count
+        self.flush()
+        self._write_snapshot()
+
+    def append(self, action, from_state, to_state, count_delta, count):
+        """
+        Append one action record, flushing the buffer when it is full.
+
+        Parameters
+        ----------
+        action : int
+            One of the ACTION_* codes.
+        from_state, to_state : AbsGBState
+            State of the machine before and after the action.
+        count_delta : int
+            Change in the number of gumballs.
+        count : int
+            Number of gumballs after the action.
+        """
+        self._state_code = STATE_CODES[type(to_state)]
+        self._count = count
+        self._buffer += self.RECORD.pack(action, STATE_CODES[type(from_state)], self._state_code, count_delta)
+        self._num_buffered += 1
+        if self._num_buffered >= self._flush_every:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered records, and a snapshot if enough records were written since the last one.
+        """
+        if not self._num_buffered:
+            return
+        self._file.write(self._buffer)
+        self._num_records += self._num_buffered
+        self._buffer.clear()
+        self._num_buffered = 0
+        if self._num_records - self._last_snapshot >= self._snapshot_every:
+            self._write_snapshot()
+
+    def _write_snapshot(self):
+        self._snapshot_file.write(self.SNAPSHOT.pack(self._num_records, self._state_code, self._count))
+        self._last_snapshot = self._num_records
+
+    def close(self):
+        self.flush()
+        self._file.close()
+        self._snapshot_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @classmethod
+    def read_records(cls, path, start=0):
+        """
+        Read the records of a log for auditing.
+
+        Returns
+        -------
+        list of tuple
+            (action, from_state_code, to_state_code, count_delta) for each record from index `start`.
+        """
+        with open(path, 'rb') as f:
+            f.seek(start * cls.RECORD.size)
+            data = f.read()
+        data = data[:len(data) - len(data) % cls.RECORD.size]
+        return list(cls.RECORD.iter_unpack(data))
+
+    @classmethod
+    def replay(cls, path):
+        """
+        Rebuild the machine state from the latest snapshot and the tail of the log.
+
+        Returns
+        -------
+        tuple
+            (state_code, count) of the machine after the last logged action.
+        """
+        with open(path + '.snap', 'rb') as f:
+            size = f.seek(0, os.SEEK_END)
+            size -= size % cls.SNAPSHOT.size
+            if size == 0:
+                raise ValueError(f'No snapshot found for transition log {path}')
+            f.seek(size - cls.SNAPSHOT.size)
+            start, state_code, count = cls.SNAPSHOT.unpack(f.read(cls.SNAPSHOT.size))
+        # only the last to-state and the sum of the count deltas matter
+        for _, _, state_code, count_delta in cls.read_records(path, start):
+            count += count_delta
+        return state_code, count
+
+
+class GumballProfiler(object):
+    """
+    Collects transition counts, per-state dwell times and sold out statistics from gumball machines.
+
+    Attach it with `GumballMachine.set_profiler`, one profiler can be shared by many machines. A machine without
+    a profiler only pays for an `is None` check per action and transition.
+    """
+    # upper bounds, in seconds, of the dwell time histogram buckets, the last bucket is unbounded
+    DWELL_BUCKETS = (1e-6, 1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1.0, 10.0, 100.0)
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._actions = dict()
+        self._transitions = dict()
+        self._dwell_counts = dict()
+        self._dwell_sums = dict()
+        self._sold_out_transitions = 0
+        self._sold_out_actions = 0
+
+    def record_action(self, action, gb_state):
+        """
+        Record an action requested while the machine is in `gb_state`.
+        """
+        self._actions[action] = self._actions.get(action, 0) + 1
+        if isinstance(gb_state, SoldOutState):
+            self._sold_out_actions += 1
+
+    def record_transition(self, from_state, to_state, dwell_time):
+        """
+        Record a transition, `dwell_time` is the time in seconds the machine spent in `from_state`.
+        """
+        key = (type(from_state), type(to_state))
+        self._transitions[key] = self._transitions.get(key, 0) + 1
+        from_class = key[0]
+        counts = self._dwell_counts.get(from_class)
+        if counts is None:
+            counts = self._dwell_counts[from_class] = [0] * (len(self.DWELL_BUCKETS) + 1)
+            self._dwell_sums[from_class] = 0.0
+        counts[bisect_left(self.DWELL_BUCKETS, dwell_time)] += 1
+        self._dwell_sums[from_class] += dwell_time
+        if isinstance(to_state, SoldOutState) and not isinstance(from_state, SoldOutState):
+            self._sold_out_transitions += 1
+
+    def snapshot(self):
+        """
+        Returns
+        -------
+        dict
+            Plain dict of the collected statistics, keyed by action and state class names.
+        """
+        bucket_names = [f'le_{bound:g}' for bound in self.DWELL_BUCKETS] + ['inf']
+        return {
+            'actions': {ACTION_NAMES[action]: n for action, n in self._actions.items()},
+            'transitions': {f'{from_class.__name__}->{to_class.__name__}': n
+                            for (from_class, to_class), n in self._transitions.items()},
+            'dwell_seconds': {
+                state_class.__name__: {
+                    'buckets': dict(zip(bucket_names, counts)),
+                    'count': sum(counts),
+                    'sum': self._dwell_sums[state_class],
+                }
+                for state_class, counts in self._dwell_counts.items()
+            },
+            'sold_out': {
+                'transitions': self._sold_out_transitions,
+                'actions': self._sold_out_actions,
+            },
+        }
+
+
 # The context
 class GumballMachine(object):
     """
     This is the "context".
     """
 
-    def __init__(self, num_gum_ball):
+    def __init__(self, num_gum_ball, transition_log=None):
         assert isinstance(num_gum_ball, int)
         self.__num_gum_ball = num_gum_ball
         self.__no_quarter_state = NoQuarterState(self)
@@ -193,19 +413,60 @@ class GumballMachine(object):
         self.__sold_out_state = SoldOutState(self)
 
         self.__state = self.__no_quarter_state if self.__num_gum_ball > 0 else self.__sold_out_state
+        self.__transition_log = None
+        if transition_log is not None:
+            self.set_transition_log(transition_log)
+        self.__profiler = None
+        self.__state_since = None
+
+    def set_profiler(self, profiler):
+        """
+        Attach a GumballProfiler, or detach it with None.
+        """
+        assert profiler is None or isinstance(profiler, GumballProfiler)
+        self.__profiler = profiler
+        self.__state_since = time.perf_counter()
+
+    def set_transition_log(self, transition_log):
+        assert isinstance(transition_log, TransitionLog)
+        transition_log.start(self.__state, self.__num_gum_ball)
+        self.__transition_log = transition_log
 
     def insert_quarter(self):
+        from_state, from_count = self.__state, self.__num_gum_ball
+        if self.__profiler is not None:
+            self.__profiler.record_action(ACTION_INSERT_QUARTER, from_state)
         self.__state.insert_quarter()
+        if self.__transition_log is not None:
+            self.__log(ACTION_INSERT_QUARTER, from_state, from_count)
 
     def eject_quarter(self):
+        from_state, from_count = self.__state, self.__num_gum_ball
+        if self.__profiler is not None:
+            self.__profiler.record_action(ACTION_EJECT_QUARTER, from_state)
         self.__state.eject_quarter()
+        if self.__transition_log is not None:
+            self.__log(ACTION_EJECT_QUARTER, from_state, from_count)
 
     def turn_crank(self):
+        from_state, from_count = self.__state, self.__num_gum_ball
+        if self.__profiler is not None:
+            self.__profiler.record_action(ACTION_TURN_CRANK, from_state)
         self.__state.turn_crank()
         self.__state.dispense()
+        if self.__transition_log is not None:
+            self.__log(ACTION_TURN_CRANK, from_state, from_count)
+
+    def __log(self, action, from_state, from_count):
+        self.__transition_log.append(action, from_state, self.__state, self.__num_gum_ball - from_count,
+                                     self.__num_gum_ball)
 
     def set_state(self, gb_state):
         assert isinstance(gb_state, AbsGBState)
+        if self.__profiler is not None:
+            now = time.perf_counter()
+            self.__profiler.record_transition(self.__state, gb_state, now - self.__state_since)
+            self.__state_since = now
         self.__state = gb_state
 
     # methods that can be used by states
@@ -235,9 +496,283 @@ class GumballMachine(object):
     def get_sold_out_state(self):
         return self.__sold_out_state
 
+    def get_state_by_code(self, state_code):
+        """
+        Returns the state of this machine for a state code used in the transition log.
+        """
+        return (self.__no_quarter_state, self.__has_quarter_state, self.__one_ball_win_state,
+                self.__two_ball_win_state, self.__sold_out_state)[state_code]
+
+    @classmethod
+    def from_transition_log(cls, path):
+        """
+        Recover a machine from its transition log.
+        """
+        state_code, count = TransitionLog.replay(path)
+        gb = cls(count)
+        gb.set_state(gb.get_state_by_code(state_code))
+        return gb
+
     def __str__(self):
         return f'State Pattern Gumball Machine total {self.__num_gum_ball} balls left'
 
+# Flyweight states
+class AbsSharedGBState(ABC):
+    """
+    Interface for gumball states shared by all machines.
+
+    Shared states hold no reference to a machine, the machine is passed to every action instead. So a single
+    instance of each state serves any number of machines.
+    """
+    @abstractmethod
+    def insert_quarter(self, gb_machine):
+        """
+        insert quarter in the machine
+        """
+
+    @abstractmethod
+    def eject_quarter(self, gb_machine):
+        """
+        eject quarter from the machine
+        """
+
+    @abstractmethod
+    def turn_crank(self, gb_machine):
+        """
+        turn the machine's crank
+        """
+
+    @abstractmethod
+    def dispense(self, gb_machine):
+        """
+        dispense gumball
+        """
+
+class SharedNoQuarterState(AbsSharedGBState):
+    def insert_quarter(self, gb_machine):
+        gb_machine.set_state(SHARED_HAS_QUARTER_STATE)
+        if gb_machine.get_count() == 0:
+            print(f'There is no gumball left in the machine!')
+            gb_machine.eject_quarter()
+
+    def eject_quarter(self, gb_machine):
+        print(f'You have not inserted a quarter')
+
+    def turn_crank(self, gb_machine):
+        print(f'You turned, but there is no quarter')
+
+    def dispense(self, gb_machine):
+        print(f'You need to pay first')
+
+class SharedHasQuarterState(AbsSharedGBState):
+    def insert_quarter(self, gb_machine):
+        print(f'You already inserted a quarter')
+
+    def eject_quarter(self, gb_machine):
+        gb_machine.set_state(SHARED_NO_QUARTER_STATE)
+
+    def turn_crank(self, gb_machine):
+        import numpy as np
+        turned_int = np.random.randint(0, 10)
+        curr_count = gb_machine.get_count()
+        if turned_int == 0 and curr_count > 1:
+            print(f'Yay, you got a winner! Double gumball!')
+            gb_machine.set_state(SHARED_TWO_BALL_WIN_STATE)
+        else:
+            assert curr_count > 0
+            print(f'You won a ball!')
+            gb_machine.set_state(SHARED_ONE_BALL_WIN_STATE)
+
+    def dispense(self, gb_machine):
+        print(f'You need to turn the crank first')
+
+class SharedOneBallWinState(AbsSharedGBState):
+    def insert_quarter(self, gb_machine):
+        print(f'You already inserted a quarter, and we are ready to dispense gumball')
+
+    def eject_quarter(self, gb_machine):
+        print(f'You already turned the crank, we are ready to dispense gumball, cannot eject quarter now')
+
+    def turn_crank(self, gb_machine):
+        print(f'You already turned the crank, we are ready to dispense gumball')
+
+    def dispense(self, gb_machine):
+        gb_machine.release_one_ball()
+        gb_machine.set_state(SHARED_NO_QUARTER_STATE if gb_machine.get_count() > 0 else SHARED_SOLD_OUT_STATE)
+
+class SharedTwoBallWinState(SharedOneBallWinState):
+    def dispense(self, gb_machine):
+        gb_machine.release_one_ball()
+        super().dispense(gb_machine)
+
+class SharedSoldOutState(AbsSharedGBState):
+    def insert_quarter(self, gb_machine):
+        print(f'All sold out, cannot accept quarter')
+
+    def eject_quarter(self, gb_machine):
+        print(f'All sold out, no quarter accepted or ejected')
+
+    def turn_crank(self, gb_machine):
+        print(f'All sold out, cannot turn crank')
+
+    def dispense(self, gb_machine):
+        print(f'All sold out')
+
+SHARED_NO_QUARTER_STATE = SharedNoQuarterState()
+SHARED_HAS_QUARTER_STATE = SharedHasQuarterState()
+SHARED_ONE_BALL_WIN_STATE = SharedOneBallWinState()
+SHARED_TWO_BALL_WIN_STATE = SharedTwoBallWinState()
+SHARED_SOLD_OUT_STATE = SharedSoldOutState()
+
+
+class FlyweightGumballMachine(object):
+    """
+    A gumball machine using the shared states.
+
+    The machine only stores its count and current state, in slots, which keeps millions of machines cheap
+    compared to GumballMachine and its five state objects per machine.
+    """
+    __slots__ = ('__num_gum_ball', '__state')
+
+    def __init__(self, num_gum_ball):
+        assert isinstance(num_gum_ball, int)
+        self.__num_gum_ball = num_gum_ball
+        self.__state = SHARED_NO_QUARTER_STATE if num_gum_ball > 0 else SHARED_SOLD_OUT_STATE
+
+    def insert_quarter(self):
+        self.__state.insert_quarter(self)
+
+    def eject_quarter(self):
+        self.__state.eject_quarter(self)
+
+    def turn_crank(self):
+        self.__state.turn_crank(self)
+        self.__state.dispense(self)
+
+    def set_state(self, gb_state):
+        assert isinstance(gb_state, AbsSharedGBState)
+        self.__state = gb_state
+
+    def release_one_ball(self):
+        print(f'A gumball comes rolling out of the slot...')
+        if self.__num_gum_ball > 0:
+            self.__num_gum_ball -= 1
+
+    def get_count(self):
+        return self.__num_gum_ball
+
+    def get_state(self):
+        return self.__state
+
+    def get_no_quarter_state(self):
+        return SHARED_NO_QUARTER_STATE
+
+    def get_has_quarter_state(self):
+        return SHARED_HAS_QUARTER_STATE
+
+    def get_one_ball_win_state(self):
+        return SHARED_ONE_BALL_WIN_STATE
+
+    def get_two_ball_win_state(self):
+        return SHARED_TWO_BALL_WIN_STATE
+
+    def get_sold_out_state(self):
+        return SHARED_SOLD_OUT_STATE
+
+    def __str__(self):
+        return f'Flyweight Gumball Machine total {self.__num_gum_ball} balls left'
+
+
+# Asyncio front end
+class AsyncGumballService(object):
+    """
+    Multiplexes many gumball machines on one event loop.
+
+    Actions are queued per machine and return futures. A machine with pending actions is scheduled once on the
+    loop and then runs up to `batch_size` of its queued actions in one go, with their output captured instead of
+    printed. The result of each future is the text the machine printed for that action.
+    """
+
+    def __init__(self, batch_size=64):
+        assert isinstance(batch_size, int) and batch_size > 0
+        self._batch_size = batch_size
+        self._machines = dict()
+        self._queues = dict()
+
+    def add_machine(self, machine_id, gb_machine):
+        assert isinstance(gb_machine, (GumballMachine, FlyweightGumballMachine))
+        self._machines[machine_id] = gb_machine
+        self._queues[machine_id] = deque()
+
+    def get_machine(self, machine_id):
+        return self._machines[machine_id]
+
+    def submit(self, machine_id, action):
+        """
+        Queue an action for a machine.
+
+        Parameters
+        ----------
+        machine_id : hashable
+            Id the machine was added with.
+        action : str
+            One of ACTION_NAMES.
+
+        Returns
+        -------
+        asyncio.Future
+            Resolves to the output of the action, or the exception it raised.
+        """
+        assert action in ACTION_NAMES
+        queue = self._queues[machine_id]
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if not queue:
+            loop.call_soon(self._run_batch, machine_id)
+        queue.append((action, future))
+        return future
+
+    def _run_batch(self, machine_id):
+        gb_machine = self._machines[machine_id]
+        queue = self._queues[machine_id]
+        out = io.StringIO()
+        with redirect_stdout(out):
+            for _ in range(min(self._batch_size, len(queue))):
+                action, future = queue.popleft()
+                start = out.tell()
+                try:
+                    getattr(gb_machine, action)()
+                except Exception as e:
+                    if not future.cancelled():
+                        future.set_exception(e)
+                    continue
+                if not future.cancelled():
+                    out.seek(start)
+                    future.set_result(out.read().rstrip('\n'))
+        if queue:
+            # yield to the other machines before running the next batch
+            asyncio.get_running_loop().call_soon(self._run_batch, machine_id)
+
+
+class LocalGumballClient(object):
+    """
+    In-process stand-in for a network client of AsyncGumballService.
+    """
+
+    def __init__(self, service):
+        assert isinstance(service, AsyncGumballService)
+        self._service = service
+
+    async def insert_quarter(self, machine_id):
+        return await self._service.submit(machine_id, 'insert_quarter')
+
+    async def eject_quarter(self, machine_id):
+        return await self._service.submit(machine_id, 'eject_quarter')
+
+    async def turn_crank(self, machine_id):
+        return await self._service.submit(machine_id, 'turn_crank')
+
+
 if __name__ == '__main__':
     """
     What if there are multiple gumball machines??
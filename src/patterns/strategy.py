@@ -5,6 +5,12 @@ Defines a family of algorithms, encapsulates each one, and makes them interchang
 Strategy lets the algorithm vary independently from clients that use it.
 '''
 from abc import ABC, abstractmethod
+from array import array
+from itertools import repeat
+import random
+import sys
+import time
+import timeit
 
 
 class AbsFlyBehavior(ABC):
@@ -55,45 +61,265 @@ class Squeak(AbsQuackBehavior):
         print('Squeak')
 
 
+# Behaviors have no state, so one instance of each can be shared by all ducks.
+FLY_WITH_WINGS = FlyWithWings()
+FLY_NO_WAY = FlyNoWay()
+QUACK = Quack()
+MUTE_QUACK = MuteQuack()
+SQUEAK = Squeak()
+
+
+class AdaptiveSelector(object):
+    """
+    Routes calls to the fastest of several interchangeable strategies.
+
+    Every call is timed and folded into an exponentially weighted mean per strategy. Each strategy is tried once,
+    afterwards the fastest one is used, except for a fraction `exploration` of the calls which go to a random
+    strategy, so the selector notices when another strategy becomes faster (epsilon-greedy bandit).
+    """
+
+    def __init__(self, strategies, method_name, exploration=0.05, decay=0.1, seed=None):
+        assert len(strategies) > 0
+        assert 0 <= exploration <= 1
+        assert 0 < decay <= 1
+        self._strategies = list(strategies)
+        self._methods = [getattr(strategy, method_name) for strategy in self._strategies]
+        self._exploration = exploration
+        self._decay = decay
+        self._random = random.Random(seed)
+        self._calls = [0] * len(self._strategies)
+        self._mean_seconds = [0.0] * len(self._strategies)
+        self._best = 0
+
+    def __call__(self, *args, **kwargs):
+        index = self._choose()
+        start = time.perf_counter()
+        result = self._methods[index](*args, **kwargs)
+        self._record(index, time.perf_counter() - start)
+        return result
+
+    def _choose(self):
+        if 0 in self._calls:
+            return self._calls.index(0)
+        if self._random.random() < self._exploration:
+            return self._random.randrange(len(self._strategies))
+        return self._best
+
+    def _record(self, index, seconds):
+        calls = self._calls[index]
+        self._calls[index] = calls + 1
+        mean = self._mean_seconds
+        mean[index] = seconds if calls == 0 else mean[index] + self._decay * (seconds - mean[index])
+        if index == self._best or mean[index] < mean[self._best]:
+            self._best = min((i for i in range(len(mean)) if self._calls[i]), key=mean.__getitem__)
+
+    def get_strategy(self):
+        """
+        Returns the strategy currently considered the fastest.
+        """
+        return self._strategies[self._best]
+
+    def get_timings(self):
+        """
+        Returns
+        -------
+        list of dict
+            Number of calls and mean call time in seconds of each strategy.
+        """
+        return [{'strategy': strategy, 'calls': calls, 'mean_seconds': mean}
+                for strategy, calls, mean in zip(self._strategies, self._calls, self._mean_seconds)]
+
+
+class AdaptiveFlyBehavior(AbsFlyBehavior):
+    """
+    A fly behavior that picks the fastest of several fly behaviors, see AdaptiveSelector.
+    """
+
+    def __init__(self, fly_behaviors, **kwargs):
+        for fly_behavior in fly_behaviors:
+            assert isinstance(fly_behavior, AbsFlyBehavior)
+        self.selector = AdaptiveSelector(fly_behaviors, 'fly', **kwargs)
+
+    def fly(self):
+        self.selector()
+
+
+class AdaptiveQuackBehavior(AbsQuackBehavior):
+    """
+    A quack behavior that picks the fastest of several quack behaviors, see AdaptiveSelector.
+    """
+
+    def __init__(self, quack_behaviors, **kwargs):
+        for quack_behavior in quack_behaviors:
+            assert isinstance(quack_behavior, AbsQuackBehavior)
+        self.selector = AdaptiveSelector(quack_behaviors, 'quack', **kwargs)
+
+    def quack(self):
+        self.selector()
+
+
 class AbsDuck(ABC):
+    """
+    The bound `fly`/`quack` methods of the behaviors are cached when a behavior is set, so performing a behavior
+    is a single call. The cache is replaced whenever the behavior changes. Tight loops can go one step further and
+    hoist the method returned by `get_fly_method`/`get_quack_method` out of the loop.
+    """
+    __slots__ = ('_fly_behavior', '_quack_behavior', '_fly', '_quack')
 
     def __init__(self, fly_behavior, quack_behavior):
-        assert isinstance(fly_behavior, AbsFlyBehavior)
-        assert isinstance(quack_behavior, AbsQuackBehavior)
-        self._fly_behavior = fly_behavior
-        self._quack_behavior = quack_behavior
+        self.set_fly_behavior(fly_behavior)
+        self.set_quack_behavior(quack_behavior)
 
     def set_fly_behavior(self, fly_behavior):
         assert isinstance(fly_behavior, AbsFlyBehavior)
         self._fly_behavior = fly_behavior
+        self._fly = fly_behavior.fly
 
     def set_quack_behavior(self, quack_behavior):
         assert isinstance(quack_behavior, AbsQuackBehavior)
         self._quack_behavior = quack_behavior
+        self._quack = quack_behavior.quack
+
+    def get_fly_method(self):
+        """
+        Returns the bound `fly` method of the current fly behavior, valid until the behavior is changed.
+        """
+        return self._fly
+
+    def get_quack_method(self):
+        """
+        Returns the bound `quack` method of the current quack behavior, valid until the behavior is changed.
+        """
+        return self._quack
 
     def perform_fly(self):
-        self._fly_behavior.fly()
+        self._fly()
 
     def perform_quack(self):
-        self._quack_behavior.quack()
+        self._quack()
 
     def swim(self):
         print('All ducks float, even decoys!')
 
 
 class MallardDuck(AbsDuck):
+    __slots__ = ()
 
     def __init__(self):
-        super().__init__(FlyWithWings(), Quack())
+        super().__init__(FLY_WITH_WINGS, QUACK)
 
     def display(self):
         print("I'm mallard duck")
 
 
 class ModelDuck(AbsDuck):
+    __slots__ = ()
 
     def __init__(self):
-        super().__init__(FlyNoWay(), Quack())
+        super().__init__(FLY_NO_WAY, QUACK)
+
+
+class DuckPopulation(object):
+    """
+    A flock of ducks stored column-wise, as arrays of behavior ids instead of duck objects.
+
+    Each distinct behavior instance gets an id, ducks share an id only when they share the behavior object, so use
+    the shared singletons (FLY_WITH_WINGS, QUACK, ...) to keep the number of behaviors small. A population holds at
+    most MAX_BEHAVIORS fly behaviors and as many quack behaviors. Performing a behavior for the whole flock looks up
+    each behavior's method once and calls it for every duck in its group, which produces the same calls as
+    performing it duck by duck, grouped by behavior.
+    """
+    # behavior ids are stored as unsigned shorts
+    MAX_BEHAVIORS = 1 << 16
+
+    def __init__(self):
+        self._fly_behaviors = list()
+        self._quack_behaviors = list()
+        # behavior ids by id() of the behavior, the behaviors lists keep the behaviors alive
+        self._fly_behavior_ids = dict()
+        self._quack_behavior_ids = dict()
+        self._fly_ids = array('H')
+        self._quack_ids = array('H')
+        # number of ducks with each behavior id, kept up to date so performing does not scan the id arrays
+        self._fly_counts = list()
+        self._quack_counts = list()
+
+    def __len__(self):
+        return len(self._fly_ids)
+
+    def _behavior_id(self, behaviors, behavior_ids, counts, behavior):
+        behavior_id = behavior_ids.get(id(behavior))
+        if behavior_id is None:
+            if len(behaviors) >= self.MAX_BEHAVIORS:
+                raise ValueError(f'A population cannot hold more than {self.MAX_BEHAVIORS} distinct behaviors, '
+                                 f'share behavior instances between ducks')
+            behavior_id = behavior_ids[id(behavior)] = len(behaviors)
+            behaviors.append(behavior)
+            counts.append(0)
+        return behavior_id
+
+    def add(self, fly_behavior, quack_behavior, num_ducks=1):
+        """
+        Add `num_ducks` ducks with the given behaviors.
+
+        Returns
+        -------
+        int
+            Index of the first added duck.
+        """
+        assert isinstance(fly_behavior, AbsFlyBehavior)
+        assert isinstance(quack_behavior, AbsQuackBehavior)
+        index = len(self)
+        fly_id = self._behavior_id(self._fly_behaviors, self._fly_behavior_ids, self._fly_counts, fly_behavior)
+        quack_id = self._behavior_id(self._quack_behaviors, self._quack_behavior_ids, self._quack_counts,
+                                     quack_behavior)
+        self._fly_ids.extend(repeat(fly_id, num_ducks))
+        self._quack_ids.extend(repeat(quack_id, num_ducks))
+        self._fly_counts[fly_id] += num_ducks
+        self._quack_counts[quack_id] += num_ducks
+        return index
+
+    def add_duck(self, duck):
+        """
+        Add a copy of the behaviors of `duck`.
+        """
+        assert isinstance(duck, AbsDuck)
+        return self.add(duck._fly_behavior, duck._quack_behavior)
+
+    def set_fly_behavior(self, index, fly_behavior):
+        assert isinstance(fly_behavior, AbsFlyBehavior)
+        old_id = self._fly_ids[index]
+        new_id = self._behavior_id(self._fly_behaviors, self._fly_behavior_ids, self._fly_counts, fly_behavior)
+        self._fly_ids[index] = new_id
+        self._fly_counts[old_id] -= 1
+        self._fly_counts[new_id] += 1
+
+    def set_quack_behavior(self, index, quack_behavior):
+        assert isinstance(quack_behavior, AbsQuackBehavior)
+        old_id = self._quack_ids[index]
+        new_id = self._behavior_id(self._quack_behaviors, self._quack_behavior_ids, self._quack_counts,
+                                   quack_behavior)
+        self._quack_ids[index] = new_id
+        self._quack_counts[old_id] -= 1
+        self._quack_counts[new_id] += 1
+
+    def get_fly_behavior(self, index):
+        return self._fly_behaviors[self._fly_ids[index]]
+
+    def get_quack_behavior(self, index):
+        return self._quack_behaviors[self._quack_ids[index]]
+
+    def perform_fly(self):
+        for behavior, count in zip(self._fly_behaviors, self._fly_counts):
+            fly = behavior.fly
+            for _ in repeat(None, count):
+                fly()
+
+    def perform_quack(self):
+        for behavior, count in zip(self._quack_behaviors, self._quack_counts):
+            quack = behavior.quack
+            for _ in repeat(None, count):
+                quack()
 
 
 class Main(object):
@@ -109,6 +335,37 @@ class Main(object):
         model.set_fly_behavior(FlyWithWings())
         model.perform_fly()
 
+    def benchmark(self, num_calls=1000000):
+        """
+        Measure calls/sec of the different ways to invoke a behavior, using a behavior that does not print.
+
+        Returns
+        -------
+        dict
+            Calls per second keyed by dispatch method.
+        """
+        class SilentFly(AbsFlyBehavior):
+            def fly(self):
+                pass
+
+        duck = ModelDuck()
+        duck.set_fly_behavior(SilentFly())
+        fly = duck.get_fly_method()
+        timers = {
+            'uncached lookup': lambda: duck._fly_behavior.fly(),
+            'perform_fly': duck.perform_fly,
+            'hoisted method': fly,
+        }
+        rates = dict()
+        for name, timer in timers.items():
+            seconds = timeit.timeit(timer, number=num_calls)
+            rates[name] = num_calls / seconds
+            print(f'{name}: {rates[name]:,.0f} calls/sec')
+        return rates
+
 
 if __name__ == '__main__':
     Main().main()
+    # python strategy.py --benchmark
+    if '--benchmark' in sys.argv[1:]:
+        Main().benchmark()
@@ -19,6 +19,23 @@ factory method (a specialization of template method).
 '''
 from abc import ABC
 from abc import abstractmethod
+from array import array
+from array import typecodes as array_typecodes
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import Future
+from concurrent.futures import as_completed
+import hashlib
+import inspect
+import json
+import mmap
+import os
+import pickle
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
 # A trivial example
 
 class CacheError(Exception):
@@ -26,13 +43,92 @@ class CacheError(Exception):
     Exception raised for errors in loading/reading cache.
     """
 
+# Instrumentation of the template methods' steps
+class AbsStepCollector(ABC):
+    """
+    Interface for collectors of template method instrumentation. Set it as the `collector` attribute of a template
+    class (for all its instances) or of an instance.
+    """
+
+    @abstractmethod
+    def record_step(self, owner, step, seconds):
+        """
+        Record that the step `step` of `owner` took `seconds`.
+        """
+
+    @abstractmethod
+    def record_cache(self, owner, hit):
+        """
+        Record a cache hit or miss of the cache computer `owner`.
+        """
+
+
+class StepStatsCollector(AbsStepCollector):
+    """
+    Collector keeping the count, total and max time per class and step, and cache hits and misses per class.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._steps = dict()
+        self._cache = dict()
+
+    def record_step(self, owner, step, seconds):
+        key = (type(owner).__name__, step)
+        with self._lock:
+            stats = self._steps.get(key)
+            if stats is None:
+                stats = self._steps[key] = [0, 0.0, 0.0]
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+
+    def record_cache(self, owner, hit):
+        with self._lock:
+            counts = self._cache.setdefault(type(owner).__name__, [0, 0])
+            counts[0 if hit else 1] += 1
+
+    def snapshot(self):
+        """
+        Returns
+        -------
+        dict
+            Plain dict of the step timings (in seconds) and cache hit counts.
+        """
+        with self._lock:
+            return {
+                'steps': {f'{class_name}.{step}': {'count': count, 'total_seconds': total, 'max_seconds': longest}
+                          for (class_name, step), (count, total, longest) in self._steps.items()},
+                'cache': {class_name: {'hits': hits, 'misses': misses, 'hit_rate': hits / (hits + misses)}
+                          for class_name, (hits, misses) in self._cache.items()},
+            }
+
+
+def _call_step(owner, step, method, *args):
+    collector = owner.collector
+    if collector is None:
+        return method(*args)
+    start = time.perf_counter()
+    try:
+        return method(*args)
+    finally:
+        collector.record_step(owner, step, time.perf_counter() - start)
+
+
+def _record_cache(owner, hit):
+    if owner.collector is not None:
+        owner.collector.record_cache(owner, hit)
+
+
 class AbsClass(ABC):
+    # an AbsStepCollector timing the steps, None to not instrument
+    collector = None
 
     def template_method(self):
-        self.operation1()
-        self.operation2()
-        self.__concrete_operation()
-        self.hook()
+        _call_step(self, 'operation1', self.operation1)
+        _call_step(self, 'operation2', self.operation2)
+        _call_step(self, 'concrete_operation', self.__concrete_operation)
+        _call_step(self, 'hook', self.hook)
 
     @abstractmethod
     def operation1(self):
@@ -62,6 +158,8 @@ class AbsCacheComputer(ABC):
     """
     Interface for algorithms using cache.
     """
+    # an AbsStepCollector timing the steps and counting cache hits, None to not instrument
+    collector = None
 
     def run(self):
         """
@@ -69,12 +167,14 @@ class AbsCacheComputer(ABC):
         """
         result = None
         try:
-            result = self.load_cache()
+            result = _call_step(self, 'load_cache', self.load_cache)
+            _record_cache(self, hit=True)
         except CacheError:
-            result = self.compute()
-            self.write_cache(result)
+            _record_cache(self, hit=False)
+            result = _call_step(self, 'compute', self.compute)
+            _call_step(self, 'write_cache', self.write_cache, result)
         finally:
-            self.clean_up()
+            _call_step(self, 'clean_up', self.clean_up)
         return result
 
     @abstractmethod
@@ -100,3 +200,749 @@ class AbsCacheComputer(ABC):
         Default behavior is to do nothing.
         """
         pass
+
+
+# Cache backends, so that subclasses don't have to implement load_cache and write_cache themselves
+class AbsCacheBackend(ABC):
+    """
+    Interface for a key-value store of computation results.
+    """
+
+    @abstractmethod
+    def get(self, key):
+        """
+        Returns the value stored for `key`, raise CacheError if there is none.
+        """
+
+    @abstractmethod
+    def set(self, key, value):
+        """
+        Store `value` for `key`.
+        """
+
+    @abstractmethod
+    def delete(self, key):
+        """
+        Remove `key`, do nothing if it is not stored.
+        """
+
+    @abstractmethod
+    def clear(self):
+        """
+        Remove all the keys.
+        """
+
+
+class MemoryLRUCache(AbsCacheBackend):
+    """
+    In-memory cache keeping at most `max_size` entries, evicting the least recently used one. Entries older than
+    `ttl` seconds, if given, are treated as missing.
+    """
+
+    def __init__(self, max_size=128, ttl=None, clock=time.monotonic):
+        assert isinstance(max_size, int) and max_size > 0
+        assert ttl is None or ttl > 0
+        self._max_size = max_size
+        self._ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires_at, value = self._entries[key]
+            except KeyError:
+                raise CacheError(f'{key} is not cached')
+            if expires_at is not None and self._clock() >= expires_at:
+                del self._entries[key]
+                raise CacheError(f'{key} expired')
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        expires_at = None if self._ttl is None else self._clock() + self._ttl
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class MmapFileCache(AbsCacheBackend):
+    """
+    On-disk cache storing each pickled value in its own file under `directory`, read back through a memory map.
+    Files are written to a temporary file and renamed, so readers never see a partial value.
+    """
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+
+    def _get_path(self, key):
+        return os.path.join(self._directory, hashlib.sha256(key.encode()).hexdigest())
+
+    def get(self, key):
+        try:
+            with open(self._get_path(key), 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as e:
+            raise CacheError(f'{key} is not cached: {e}')
+        return self._load(mapped)
+
+    def _load(self, mapped):
+        """
+        Deserialize a value from the memory mapped file.
+        """
+        with mapped:
+            return pickle.loads(mapped)
+
+    def _dump(self, value, f):
+        """
+        Serialize a value to the open file `f`.
+        """
+        pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def set(self, key, value):
+        fd, tmp_path = tempfile.mkstemp(dir=self._directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                self._dump(value, f)
+            os.replace(tmp_path, self._get_path(key))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def delete(self, key):
+        try:
+            os.unlink(self._get_path(key))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        for name in os.listdir(self._directory):
+            os.unlink(os.path.join(self._directory, name))
+
+
+# Zero-copy serialization: large buffers are stored raw and loaded as views of the memory mapped file
+ZERO_COPY_MAGIC = b'ZCR2'
+ZERO_COPY_ALIGNMENT = 64
+# magic, whether the value is a raw buffer, pickle length, number of out-of-band buffers
+ZERO_COPY_HEADER = struct.Struct('<4s?QQ')
+ZERO_COPY_BUFFER = struct.Struct('<QQ')
+RAW_BUFFER_TYPES = (bytes, bytearray, memoryview, array)
+
+
+def _align(offset):
+    return -(-offset // ZERO_COPY_ALIGNMENT) * ZERO_COPY_ALIGNMENT
+
+
+def _is_castable(buffer_format):
+    # memoryview.cast only supports single native formats, e.g. not '<i' or the structured formats of numpy
+    try:
+        memoryview(bytes(struct.calcsize(buffer_format))).cast(buffer_format)
+    except (ValueError, TypeError, struct.error):
+        return False
+    return True
+
+
+def dump_zero_copy(value, f):
+    """
+    Write `value` to the binary file `f` so that `load_zero_copy` can load it without copying its buffers.
+
+    The value is pickled with protocol 5, buffers that support out-of-band pickling (e.g. numpy arrays) and values
+    that are themselves buffers (bytes, bytearray, memoryview, array) are written raw after the pickle, each aligned
+    to ZERO_COPY_ALIGNMENT bytes, along with their format and shape. Other objects are simply pickled, as are
+    memoryviews whose format memoryview.cast does not support, which are stored as bytes.
+    """
+    is_raw = False
+    if isinstance(value, RAW_BUFFER_TYPES):
+        view = memoryview(value)
+        if _is_castable(view.format):
+            is_raw = True
+            raw = view.cast('B') if view.c_contiguous and view.nbytes else memoryview(view.tobytes())
+            value = (view.format, view.shape, pickle.PickleBuffer(raw))
+        elif isinstance(value, memoryview):
+            value = view.tobytes()
+    buffers = list()
+    data = pickle.dumps(value, protocol=5, buffer_callback=buffers.append)
+    raws = [buffer.raw() for buffer in buffers]
+
+    offset = ZERO_COPY_HEADER.size + ZERO_COPY_BUFFER.size * len(raws) + len(data)
+    table = list()
+    for raw in raws:
+        offset = _align(offset)
+        table.append(ZERO_COPY_BUFFER.pack(offset, raw.nbytes))
+        offset += raw.nbytes
+    f.write(ZERO_COPY_HEADER.pack(ZERO_COPY_MAGIC, is_raw, len(data), len(raws)))
+    f.write(b''.join(table))
+    f.write(data)
+    position = ZERO_COPY_HEADER.size + ZERO_COPY_BUFFER.size * len(raws) + len(data)
+    for raw in raws:
+        padding = _align(position) - position
+        f.write(bytes(padding))
+        f.write(raw)
+        position += padding + raw.nbytes
+
+
+def load_zero_copy(buffer):
+    """
+    Load a value written by `dump_zero_copy` from `buffer`, e.g. a memory map of the file.
+
+    Raw buffers are returned as read-only memoryviews of `buffer` with their original format and shape, whatever
+    their original type was (bytes, bytearray, array), out-of-band buffers (e.g. numpy arrays) are views of `buffer`
+    as well, which stays alive as long as the loaded value does. An empty raw buffer is returned as an empty
+    memoryview, with its original format if it is an array typecode.
+
+    Raises CacheError if `buffer` cannot be decoded, so a corrupted file is recomputed.
+    """
+    try:
+        view = memoryview(buffer)
+        magic, is_raw, data_len, num_buffers = ZERO_COPY_HEADER.unpack_from(view)
+        if magic != ZERO_COPY_MAGIC:
+            raise CacheError('Not a zero-copy cache file')
+        position = ZERO_COPY_HEADER.size
+        buffers = list()
+        for _ in range(num_buffers):
+            offset, length = ZERO_COPY_BUFFER.unpack_from(view, position)
+            buffers.append(view[offset:offset + length].toreadonly())
+            position += ZERO_COPY_BUFFER.size
+        value = pickle.loads(view[position:position + data_len], buffers=buffers)
+        if is_raw:
+            buffer_format, shape, raw = value
+            raw = memoryview(raw)
+            if raw.nbytes == 0:
+                # memoryview.cast rejects shapes with zeros
+                typecode = buffer_format.lstrip('@')
+                return memoryview(array(typecode) if typecode in array_typecodes else b'').toreadonly()
+            value = raw.cast('B').cast(buffer_format, shape)
+        return value
+    except CacheError:
+        raise
+    except Exception as e:
+        raise CacheError(f'Cannot decode zero-copy cache file: {e!r}')
+
+
+class ZeroCopyFileCache(MmapFileCache):
+    """
+    MmapFileCache using the zero-copy serialization, cache hits on large array results only map the file.
+
+    Unlike the other backends, raw buffer results (bytes, bytearray, memoryview, array) are loaded as read-only
+    memoryviews of the mapped file rather than objects of their original type, copy them (e.g. `bytes(value)`,
+    `array(typecode, value)`) where the original type is needed.
+    """
+
+    def _load(self, mapped):
+        return load_zero_copy(mapped)
+
+    def _dump(self, value, f):
+        dump_zero_copy(value, f)
+
+
+class SQLiteCache(AbsCacheBackend):
+    """
+    Cache storing pickled values in a SQLite database.
+    """
+
+    def __init__(self, path):
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB)')
+
+    def get(self, key):
+        with self._lock:
+            row = self._connection.execute('SELECT value FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            raise CacheError(f'{key} is not cached')
+        return pickle.loads(row[0])
+
+    def set(self, key, value):
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock, self._connection:
+            self._connection.execute('INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)', (key, blob))
+
+    def delete(self, key):
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def clear(self):
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM cache')
+
+    def close(self):
+        self._connection.close()
+
+
+# Single-flight: concurrent callers computing the same key share one computation
+class SingleFlight(object):
+    """
+    Deduplicates concurrent calls across threads: while a call for a key is running, other callers for the same
+    key wait for it and get its result (or its exception) instead of calling again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = dict()
+
+    def do(self, key, func):
+        with self._lock:
+            future = self._calls.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = self._calls[key] = Future()
+        if not is_leader:
+            return future.result()
+        try:
+            result = func()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+class AsyncSingleFlight(object):
+    """
+    Asyncio version of SingleFlight, `do` awaits `coroutine_function()` once per key at a time.
+    """
+
+    def __init__(self):
+        self._calls = dict()
+
+    async def do(self, key, coroutine_function):
+        future = self._calls.get(key)
+        if future is not None:
+            # shield so that a cancelled follower doesn't cancel the leader's computation
+            return await asyncio.shield(future)
+        future = self._calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await coroutine_function()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # the exception is raised in the leader, don't warn if no follower retrieves it
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._calls[key]
+
+
+class BackendCacheComputer(AbsCacheComputer, ABC):
+    """
+    A cache computer storing its result in an AbsCacheBackend, subclasses only implement `compute` and, when several
+    computers share a backend, `get_cache_key`.
+
+    Computers sharing a SingleFlight compute a missing key only once when they run concurrently, the others wait
+    for that result instead of all recomputing it after a cache flush.
+    """
+
+    def __init__(self, cache_backend, single_flight=None):
+        assert isinstance(cache_backend, AbsCacheBackend)
+        assert single_flight is None or isinstance(single_flight, SingleFlight)
+        self._cache_backend = cache_backend
+        self._single_flight = single_flight
+
+    def get_cache_backend(self):
+        return self._cache_backend
+
+    def get_cache_key(self):
+        """
+        Key of the result in the backend, default is the class name.
+        """
+        return f'{type(self).__module__}.{type(self).__qualname__}'
+
+    def load_cache(self):
+        return self._cache_backend.get(self.get_cache_key())
+
+    def write_cache(self, result):
+        self._cache_backend.set(self.get_cache_key(), result)
+
+    def run(self):
+        if self._single_flight is None:
+            return super().run()
+        try:
+            try:
+                result = _call_step(self, 'load_cache', self.load_cache)
+            except CacheError:
+                _record_cache(self, hit=False)
+                return self._single_flight.do(self.get_cache_key(), self._load_or_compute)
+            _record_cache(self, hit=True)
+            return result
+        finally:
+            _call_step(self, 'clean_up', self.clean_up)
+
+    def _load_or_compute(self):
+        # another caller may have written the result since our cache miss
+        try:
+            return _call_step(self, 'load_cache', self.load_cache)
+        except CacheError:
+            result = _call_step(self, 'compute', self.compute)
+            _call_step(self, 'write_cache', self.write_cache, result)
+            return result
+
+
+class AsyncCacheComputer(BackendCacheComputer, ABC):
+    """
+    A cache computer that can also be run from asyncio with `run_async`.
+
+    The hooks stay synchronous, `run_async` runs them on `executor` (the loop's default thread pool by default):
+    * stale-while-revalidate: a cached result older than `max_age` seconds is returned right away and recomputed in
+      the background.
+    * write-behind: after a cache miss the result is returned as soon as it is computed, `write_cache` runs in the
+      background. `wait_background` waits for the pending refreshes and writes, and raises the first of their errors.
+    Concurrent misses and refreshes for the same key are computed once per AsyncSingleFlight. A miss keeps its flight
+    open until the result is written, and checks the cache again inside the flight, so callers arriving meanwhile
+    wait for the result instead of computing it again. A failed write-behind is only reported by `wait_background`,
+    the callers of the flight all get the computed result.
+    As in `run`, `clean_up` runs last: after the background refresh or write started by the call, if any.
+
+    The backend stores `(written_at, result)` pairs, `load_cache` still returns the bare result so `run` works too.
+    """
+
+    def __init__(self, cache_backend, max_age=None, executor=None, single_flight=None, async_single_flight=None):
+        super().__init__(cache_backend, single_flight)
+        assert max_age is None or max_age >= 0
+        if async_single_flight is None:
+            async_single_flight = AsyncSingleFlight()
+        assert isinstance(async_single_flight, AsyncSingleFlight)
+        self._max_age = max_age
+        self._executor = executor
+        self._async_single_flight = async_single_flight
+        self._background = set()
+
+    def load_cache_entry(self):
+        """
+        Returns
+        -------
+        tuple
+            (written_at, result), raise CacheError if there is no cached result.
+        """
+        return self._cache_backend.get(self.get_cache_key())
+
+    def load_cache(self):
+        return self.load_cache_entry()[1]
+
+    def write_cache(self, result):
+        self._cache_backend.set(self.get_cache_key(), (time.time(), result))
+
+    def _in_background(self, awaitable):
+        task = asyncio.ensure_future(awaitable)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+        return task
+
+    async def _compute(self, computed=None):
+        # compute and write the result, with `computed` the write is behind: `computed` receives the result as soon
+        # as it is computed, and an error of the write is left to `wait_background`
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(self._executor, _call_step, self, 'compute', self.compute)
+        write = loop.run_in_executor(self._executor, _call_step, self, 'write_cache', self.write_cache, result)
+        if computed is None:
+            await write
+            return result
+        if not computed.done():
+            computed.set_result(result)
+        await asyncio.wait((self._in_background(write),))
+        return result
+
+    async def _load_or_compute(self, computed):
+        # another caller may have written the result since our cache miss
+        loop = asyncio.get_running_loop()
+        try:
+            _, result = await loop.run_in_executor(self._executor, _call_step, self, 'load_cache',
+                                                   self.load_cache_entry)
+        except CacheError:
+            return await self._compute(computed)
+        if not computed.done():
+            computed.set_result(result)
+        return result
+
+    async def run_async(self):
+        """
+        The asyncio version of `run`.
+        """
+        loop = asyncio.get_running_loop()
+        key = self.get_cache_key()
+        # background work of this call that may still use the hooks, clean_up runs once it is done
+        pending = None
+        try:
+            try:
+                written_at, result = await loop.run_in_executor(self._executor, _call_step, self, 'load_cache',
+                                                                self.load_cache_entry)
+            except CacheError:
+                _record_cache(self, hit=False)
+                # the flight goes on until the result is written (write-behind), the leader returns as soon as
+                # `computed` is set, followers when the flight is done
+                computed = loop.create_future()
+                pending = asyncio.ensure_future(self._async_single_flight.do(
+                    key, lambda: self._load_or_compute(computed)))
+                await asyncio.wait((pending, computed), return_when=asyncio.FIRST_COMPLETED)
+                if pending.done():
+                    flight, pending = pending, None
+                    return flight.result()
+                return computed.result()
+            _record_cache(self, hit=True)
+            if self._max_age is not None and time.time() - written_at > self._max_age:
+                pending = self._in_background(self._async_single_flight.do(key, self._compute))
+            return result
+        finally:
+            if pending is None:
+                await loop.run_in_executor(self._executor, _call_step, self, 'clean_up', self.clean_up)
+            else:
+                self._in_background(self._clean_up_after(pending))
+
+    async def _clean_up_after(self, pending):
+        await asyncio.wait((pending,))
+        await asyncio.get_running_loop().run_in_executor(self._executor, _call_step, self, 'clean_up', self.clean_up)
+
+    async def wait_background(self):
+        """
+        Wait for the pending background refreshes and cache writes, then raise the first of their errors.
+        """
+        errors = list()
+        while self._background:
+            results = await asyncio.gather(*self._background, return_exceptions=True)
+            errors.extend(result for result in results if isinstance(result, Exception))
+        if errors:
+            raise errors[0]
+
+
+# Cache keys derived from the inputs of the computation
+class FileDigests(object):
+    """
+    Computes content digests of input files, remembering them by (size, mtime) so unchanged files are not read
+    again. Large files are hashed in chunks of `chunk_size` bytes.
+    """
+
+    def __init__(self, chunk_size=1 << 20):
+        self._chunk_size = chunk_size
+        self._digests = dict()
+        self._lock = threading.Lock()
+
+    def get_digest(self, path):
+        stat = os.stat(path)
+        signature = (stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            known = self._digests.get(path)
+        if known is not None and known[0] == signature:
+            return known[1]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(self._chunk_size), b''):
+                digest.update(chunk)
+        digest = digest.hexdigest()
+        with self._lock:
+            self._digests[path] = (signature, digest)
+        return digest
+
+
+DEFAULT_FILE_DIGESTS = FileDigests()
+
+
+class FingerprintCacheComputer(BackendCacheComputer, ABC):
+    """
+    A cache computer whose cache key is a fingerprint of its inputs: its parameters, its input files and the
+    version of its code. When any of them changes the key changes, so a stale result is never loaded.
+
+    With `hash_files` the content of the input files is hashed (memoized by size and mtime, see FileDigests),
+    otherwise only their size and mtime are used, which is cheaper but sensitive to touching a file.
+
+    The fingerprint is computed once at the start of `run`, loading, the single flight and writing all use that key,
+    so an input changing during the computation cannot store the result under the new fingerprint. The key is kept
+    per thread, so runs of the same computer in several threads each use their own fingerprint.
+    """
+
+    def __init__(self, cache_backend, single_flight=None, hash_files=True, file_digests=DEFAULT_FILE_DIGESTS):
+        super().__init__(cache_backend, single_flight)
+        assert isinstance(file_digests, FileDigests)
+        self._hash_files = hash_files
+        self._file_digests = file_digests
+        # key of the run in progress in each thread
+        self._run_keys = threading.local()
+
+    def get_parameters(self):
+        """
+        Returns the parameters of the computation as a dict, values should be JSON serializable or have a stable repr.
+        """
+        return dict()
+
+    def get_input_paths(self):
+        """
+        Returns the paths of the files the computation reads.
+        """
+        return ()
+
+    def get_code_version(self):
+        """
+        Returns a version of the computation's code, by default the hash of the source of `compute`.
+        """
+        try:
+            source = inspect.getsource(type(self).compute)
+        except (OSError, TypeError):
+            return type(self).__qualname__
+        return hashlib.sha256(source.encode()).hexdigest()
+
+    def get_fingerprint(self):
+        digest = hashlib.sha256()
+        digest.update(json.dumps(self.get_parameters(), sort_keys=True, default=repr).encode())
+        for path in self.get_input_paths():
+            if self._hash_files:
+                file_version = self._file_digests.get_digest(path)
+            else:
+                stat = os.stat(path)
+                file_version = f'{stat.st_size}:{stat.st_mtime_ns}'
+            digest.update(f'\0{path}\0{file_version}'.encode())
+        digest.update(f'\0{self.get_code_version()}'.encode())
+        return digest.hexdigest()
+
+    def get_cache_key(self):
+        key = getattr(self._run_keys, 'key', None)
+        if key is not None:
+            return key
+        return f'{super().get_cache_key()}:{self.get_fingerprint()}'
+
+    def run(self):
+        previous_key = getattr(self._run_keys, 'key', None)
+        self._run_keys.key = self.get_cache_key()
+        try:
+            return super().run()
+        finally:
+            self._run_keys.key = previous_key
+
+
+def _timed_compute_partition(computer, partition):
+    # module level so that it can be submitted to a process pool
+    start = time.perf_counter()
+    try:
+        result, error = computer.compute_partition(partition), None
+    except Exception as e:
+        result, error = None, e
+    return partition, time.perf_counter() - start, result, error
+
+
+class ChunkedCacheComputer(BackendCacheComputer, ABC):
+    """
+    A cache computer for results made of partitions, each partition is cached on its own.
+
+    `run` loads the cached partitions, only computes the missing ones (on `executor` if given, e.g. a process pool)
+    and merges all of them. Each partition is written as soon as it is computed, so when a partition fails the
+    others are still cached and the first error is raised once all of them are done. A partition is invalidated by
+    changing its version, see `get_partition_version`, so a small change of the input only recomputes the partitions
+    it touches.
+
+    With a process pool the computer is pickled to the workers without its cache backend, executor and collector,
+    the rest of its state must be picklable. `compute_partition` is timed in the workers and recorded by the
+    collector of the submitting computer.
+    """
+
+    def __init__(self, cache_backend, executor=None):
+        super().__init__(cache_backend)
+        self._executor = executor
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_cache_backend'] = None
+        state['_executor'] = None
+        state.pop('collector', None)
+        return state
+
+    @abstractmethod
+    def get_partitions(self):
+        """
+        Returns the partitions of the result, e.g. names of the dataset partitions.
+        """
+
+    @abstractmethod
+    def compute_partition(self, partition):
+        """
+        Perform the computation for one partition, and return its result.
+        """
+
+    @abstractmethod
+    def merge(self, partition_results):
+        """
+        Merge the results of the partitions, given as a dict ordered like `get_partitions`, into the final result.
+        """
+
+    def get_partition_version(self, partition):
+        """
+        Returns a version of the partition's input, the cached partition is recomputed when it changes.
+        Default is an empty version, so partitions are only computed once.
+        """
+        return ''
+
+    def get_partition_key(self, partition):
+        return f'{self.get_cache_key()}:{partition}:{self.get_partition_version(partition)}'
+
+    def compute(self):
+        partitions = self.get_partitions()
+        partition_results = dict()
+        error = None
+        for partition, result, partition_error in self._iter_computed_partitions(partitions):
+            error = error or partition_error
+            partition_results[partition] = result
+        if error is not None:
+            raise error
+        return self.merge({partition: partition_results[partition] for partition in partitions})
+
+    def _iter_computed_partitions(self, partitions):
+        # yields (partition, result, error) as the partitions complete, recording the time of compute_partition
+        if self._executor is None or len(partitions) < 2:
+            completed = (_timed_compute_partition(self, partition) for partition in partitions)
+        else:
+            futures = [self._executor.submit(_timed_compute_partition, self, partition) for partition in partitions]
+            completed = (future.result() for future in as_completed(futures))
+        for partition, seconds, result, error in completed:
+            if self.collector is not None:
+                self.collector.record_step(self, 'compute_partition', seconds)
+            yield partition, result, error
+
+    def run(self):
+        try:
+            partitions = self.get_partitions()
+            keys = {partition: self.get_partition_key(partition) for partition in partitions}
+            partition_results = dict()
+            missing = list()
+            for partition in partitions:
+                try:
+                    partition_results[partition] = _call_step(self, 'load_cache', self._cache_backend.get,
+                                                              keys[partition])
+                    _record_cache(self, hit=True)
+                except CacheError:
+                    _record_cache(self, hit=False)
+                    missing.append(partition)
+
+            error = None
+            for partition, result, partition_error in self._iter_computed_partitions(missing):
+                if partition_error is not None:
+                    error = error or partition_error
+                    continue
+                _call_step(self, 'write_cache', self._cache_backend.set, keys[partition], result)
+                partition_results[partition] = result
+            if error is not None:
+                raise error
+            return _call_step(self, 'merge', self.merge,
+                              {partition: partition_results[partition] for partition in partitions})
+        finally:
+            _call_step(self, 'clean_up', self.clean_up)